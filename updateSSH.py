@@ -1,9 +1,32 @@
+import asyncio
+import codecs
 import json
+import os
 import re
+import shutil
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    from onepassword.client import Client
+except ImportError:
+    Client = None
+
+
+def _detectIdentityAgent():
+    """Returns the path of the 1Password SSH agent socket of the current platform"""
+    if sys.platform.startswith('linux'):
+        return '~/.1password/agent.sock'
+    elif sys.platform.startswith('darwin'):
+        return '"~/Library/Group Containers/2BUA8C4S2C.com.1password/t/agent.sock"'
+    return None
+
+
+# The platform doesn't change at runtime, so the agent is only detected once
+_IDENTITY_AGENT = _detectIdentityAgent()
+
 
 class SSHKeyImporter():
     """Uses the 1Password command line interface to load ssh keys and export the public keys to the file system.
@@ -11,97 +34,158 @@ class SSHKeyImporter():
     The importer will make use of additional fields if they are labelled as follows:
     - URL: Will be used as the HostName of the SSH Server
     - User: Will be used as the default user to log into the SSH Server
-    - Labels: Will be used as alias for the SSH Command"""
+    - Labels: Will be used as alias for the SSH Command
+    If the 1Password SDK (onepassword-sdk) is installed and OP_SERVICE_ACCOUNT_TOKEN is set, the SDK is used instead of the command line interface."""
     HOME_DIR = Path.home()
     SSH_CONFIG_DIR = HOME_DIR / '.ssh'
     EXPORT_PUBKEY_DIR = SSH_CONFIG_DIR / '1passwordpubkeys'
+    CACHE_FILE = EXPORT_PUBKEY_DIR / '.cache.json'
+    CACHED_FIELDS = ('url', 'user', 'labels', 'public key')
+    FIELDS = 'label=URL,label=User,label=Labels,label=public key'
+    # Error of op versions that treat the '-' of 'op item get -' as an item name instead of reading the items from stdin
+    OP_STDIN_UNSUPPORTED_ERROR = b'"-" isn\'t an item'
+
+    # An absolute executable path (together with close_fds=False, see _getPublicKey) allows subprocess to start op with posix_spawn instead of fork/exec
+    OP = shutil.which('op') or 'op'
 
+    VAULT = 'Personal'
     TAGS = 'SSH-Key,SSH-Keys'
+    FETCH_WORKERS = 8
+    EXPORT_WORKERS = 32
+
+    _SHORT_TITLE_RE = re.compile(r'(ssh(-key)?)|[^a-z0-9]+')
+    _LABEL_SPLIT_RE = re.compile(r'[ ,]+')
 
-    def __init__(self, useraction='prompt', urlaction='prompt', labelsaction='prompt'):
+    def __init__(self, useraction='prompt', urlaction='prompt', labelsaction='prompt', useCache=True):
         self.useraction = useraction
         self.urlaction = urlaction
         self.labelsaction = labelsaction
+        self.useCache = useCache
+        self._logLines = []
 
-        if sys.platform.startswith('linux'):
-            self.identityAgent = '~/.1password/agent.sock'
-        elif sys.platform.startswith('darwin'):
-            self.identityAgent = '"~/Library/Group Containers/2BUA8C4S2C.com.1password/t/agent.sock"'
-        else:
-            self.identityAgent = None
+        self.identityAgent = _IDENTITY_AGENT
+
+        self.client = None
+        self._loop = None
+        if Client and (token := os.environ.get('OP_SERVICE_ACCOUNT_TOKEN')):
+            self._loop = asyncio.new_event_loop()
+            try:
+                self.client = self._loop.run_until_complete(Client.authenticate(
+                    auth=token, integration_name='1Password SSH-Key Importer', integration_version='v1.0.0'
+                ))
+            except Exception as error:
+                print(f'WARNING: Couldn\'t authenticate with the 1Password SDK ({error}), using the command line interface instead')
+                self.close()
 
     def startImport(self):
         """Loads SSH keys from 1Password, exports the public keys and writes the ssh config file"""
-        self.getKeyList()
+        try:
+            self.getKeyList()
+        finally:
+            self.close()
         self.exportKeys()
         self.writeHostFile()
+        self.writeCache()
+
+    def close(self):
+        """Releases the 1Password SDK client and its event loop. Later calls use the command line interface."""
+        self.client = None
+        if self._loop:
+            self._loop.close()
+            self._loop = None
 
     def getKeyList(self):
         """Loads the SSH key list"""
-        print('Loading SSH Keys from 1Password')
-        try:
-            jsonData = subprocess.check_output(f'op item list --vault=Personal --tags={self.TAGS} --format=json', shell=True)
-        except subprocess.CalledProcessError:
+        self._log('Loading SSH Keys from 1Password')
+        self._flushLog()
+        self.keys = self._listKeys()
+
+        # Only load items that changed since the last run
+        cache = self._loadCache() if self.useCache else {}
+        staleKeys = [
+            key for key in self.keys
+            if not key.get('updated_at') or cache.get(key['id'], {}).get('updated_at') != key['updated_at']
+        ]
+        publicKeys = self._getPublicKeys(staleKeys, cache)
+        for key in staleKeys:
+            if key['id'] in publicKeys:
+                fields = publicKeys[key['id']]
+                cache[key['id']] = {'updated_at': key.get('updated_at')}
+                cache[key['id']].update({name: fields[name] for name in self.CACHED_FIELDS if name in fields})
+
+        # Items that couldn't be loaded keep their previously cached fields or are skipped
+        listedKeys = self.keys
+        self.keys = [key for key in listedKeys if key['id'] in cache]
+        if listedKeys and not self.keys:
             print('ERROR: Couldn\'t load SSH keys from 1Password')
             sys.exit(1)
-        self.keys = json.loads(jsonData)
+        self.cache = {}
         for key in self.keys:
-            try:
-                key.update(self._getPublicKey(key))
-            except subprocess.CalledProcessError:
-                continue
+            self.cache[key['id']] = cache[key['id']]
+            key.update(cache[key['id']])
+            key['fileName'] = self.EXPORT_PUBKEY_DIR / f'{self._getShortTitle(key)}.pub'
+            self._log(f'Loaded {key["title"]!r}')
             self.handleMissingFields(key)
-        print()
+        self._log('')
+        self._flushLog()
 
     def exportKeys(self):
         """Exports all loaded public keys to EXPORT_PUBKEY_DIR"""
         if not self.EXPORT_PUBKEY_DIR.exists():
             self.EXPORT_PUBKEY_DIR.mkdir()
 
-        for key in self.keys:
-            if 'public key' in key:
-                key['fileName'] = self.EXPORT_PUBKEY_DIR / f"{self._getShortTitle(key)}.pub"
-                print(f'Exporting {key["title"]!r} to {key["fileName"]!r}')
-                with open(key['fileName'], 'w') as f:
-                    f.write(key['public key'])
-        print()
+        exportedKeys = [key for key in self.keys if 'public key' in key]
+        for key in exportedKeys:
+            self._log(f'Exporting {key["title"]!r} to {key["fileName"]!r}')
+        if exportedKeys:
+            with ThreadPoolExecutor(max_workers=min(self.EXPORT_WORKERS, len(exportedKeys))) as executor:
+                # Consuming the results re-raises errors of the single writes
+                list(executor.map(lambda key: key['fileName'].write_text(key['public key']), exportedKeys))
+        self._log('')
+        self._flushLog()
 
     def handleMissingFields(self, key):
         """Checks if all required fields are set and prompts them if not"""
+        shortTitle = self._getShortTitle(key)
         if not key.get('url'):
             if self.urlaction == 'prompt':
-                print('  - Key has no URL. You can provide it now.')
-                key['url'] = input('  >>> ')
+                self._log('  - Key has no URL. You can provide it now.')
+                key['url'] = self._prompt()
             else:
                 key['url'] = ''
 
             if key['url']:
-                key['updated_fields'] = ['url']
+                key.setdefault('updated_fields', []).append('url')
         if not key.get('user'):
             if self.useraction == 'prompt':
-                print('  - Key has no Username. You can provide it now.')
-                key['user'] = input('  >>> ')
+                self._log('  - Key has no Username. You can provide it now.')
+                key['user'] = self._prompt()
             elif self.useraction == 'leave-empty':
                 key['user'] = ''
             else:
                 key['user'] = self.useraction
 
             if key['user']:
-                key['updated_fields'] = key.get('updated_fields', []) + ['user']
+                key.setdefault('updated_fields', []).append('user')
         if not key.get('labels'):
-            defaults = [self._getShortTitle(key), key['url']]
+            defaults = [shortTitle, key['url']]
             if self.labelsaction == 'prompt':
-                print(f'  - Key has no labels. You can provide them now. (Leave empty for default "{self._getShortTitle(key)}", "{key["url"]}")')
-                key['labels'] = self._splitLabels(input('  >>> ')) or defaults
+                self._log(f'  - Key has no labels. You can provide them now. (Leave empty for default "{shortTitle}", "{key["url"]}")')
+                key['labels'] = self._splitLabels(self._prompt()) or defaults
             else:
                 key['labels'] = defaults
 
             if key['labels']:
-                key['updated_fields'] = key.get('updated_fields', []) + ['labels']
+                key.setdefault('updated_fields', []).append('labels')
         else:
             key['labels'] = self._splitLabels(key['labels'])
 
 
+    def writeCache(self):
+        """Stores the loaded fields of all keys in CACHE_FILE, so unchanged items don't have to be loaded again"""
+        with open(self.CACHE_FILE, 'w') as f:
+            json.dump(self.cache, f, indent=2)
+
     def writeHostFile(self):
         """Writes a ssh config file with all valid hosts/keys that can be included in ~/.ssh/config"""
         hosts = [(
@@ -121,27 +205,181 @@ class SSHKeyImporter():
                 hosts[-1].append(f'  IdentityAgent {self.identityAgent}')
 
         fileName = self.EXPORT_PUBKEY_DIR / 'config'
+        output = ''.join('\n'.join(host) + '\n\n' for host in hosts if len(host) > 1)
+        self._log(f'Writing config file: {fileName}')
         with open(fileName, 'w') as f:
-            print('Writing config file:', fileName)
-            for host in hosts:
-                if len(host) == 1:
-                    continue
-                f.write('\n'.join(host))
-                f.write('\n\n')
-        print('\nDone. Please make sure that your "~/.ssh/config" file starts with the following line:')
-        print('Include ', fileName)
-
-    def _getPublicKey(self, key):
-        """Loads URL and public key for a given item id"""
-        keyData = subprocess.check_output(f'op item get {key["id"]} --format=JSON', shell=True)
-        print(f'Loaded {key["title"]!r}')
-        return {entry['label'].lower(): entry.get('value') for entry in json.loads(keyData)['fields']}
+            f.write(output)
+        self._log('')
+        self._log('Done. Please make sure that your "~/.ssh/config" file starts with the following line:')
+        self._log(f'Include  {fileName}')
+        self._flushLog()
+
+    def _log(self, line):
+        """Collects progress output, so it is written in one go by _flushLog instead of blocking on every line"""
+        self._logLines.append(line)
+
+    def _flushLog(self):
+        if self._logLines:
+            sys.stdout.write('\n'.join(self._logLines) + '\n')
+            sys.stdout.flush()
+            self._logLines.clear()
+
+    def _prompt(self):
+        self._flushLog()
+        return input('  >>> ')
+
+    def _loadCache(self):
+        try:
+            with open(self.CACHE_FILE) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _listKeys(self):
+        """Lists all items in VAULT that are tagged with at least one of TAGS"""
+        if self.client:
+            try:
+                return self._loop.run_until_complete(self._listKeysWithSdk())
+            except Exception as error:
+                print(f'WARNING: Couldn\'t load SSH keys with the 1Password SDK ({error}), using the command line interface instead')
+                self.close()
+
+        try:
+            jsonData = subprocess.check_output([self.OP, 'item', 'list', f'--vault={self.VAULT}', f'--tags={self.TAGS}', '--format=json'])
+        except (subprocess.CalledProcessError, OSError):
+            print('ERROR: Couldn\'t load SSH keys from 1Password')
+            sys.exit(1)
+        return json.loads(jsonData)
+
+    async def _listKeysWithSdk(self):
+        for vault in await self.client.vaults.list():
+            if vault.title == self.VAULT:
+                break
+        else:
+            raise LookupError(f'Vault {self.VAULT!r} not found')
+
+        tags = {tag.lower() for tag in self.TAGS.split(',')}
+        return [
+            {'id': item.id, 'title': item.title, 'vault': {'id': vault.id}, 'updated_at': str(item.updated_at)}
+            for item in await self.client.items.list(vault.id)
+            if tags.intersection(tag.lower() for tag in item.tags)
+        ]
+
+    def _getPublicKeys(self, keys, cache=None):
+        """Loads URL and public key for all given items with a single op call (or concurrent SDK requests).
+        op reads the item list from stdin and prints one JSON object per item. Items that couldn't be loaded are missing from the result."""
+        if not keys:
+            return {}
+        if self.client:
+            return self._loop.run_until_complete(self._getPublicKeysWithSdk(keys))
+
+        publicKeys = {}
+        command = [self.OP, 'item', 'get', '-', '--format=JSON']
+        with subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0) as proc, ThreadPoolExecutor(max_workers=2) as executor:
+            # Feed the item list and read the errors in the background, so items are parsed while op is still loading the following ones
+            writer = executor.submit(self._writeInput, proc.stdin, json.dumps(keys).encode())
+            errors = executor.submit(proc.stderr.read)
+            try:
+                for item in self._iterJson(proc.stdout):
+                    if 'id' in item and 'fields' in item:
+                        publicKeys[item['id']] = self._parseFields(item)
+            except BaseException:
+                # Otherwise op blocks on its full stdout pipe and the writer never finishes
+                proc.kill()
+                raise
+            writer.result()
+        sys.stderr.write(errors.result().decode(errors='replace'))
+
+        # Load the remaining items one by one if the batched call loaded some items or if op doesn't support reading items from stdin.
+        # Other failures (e.g. not being signed in) would just repeat for every item.
+        stdinUnsupported = proc.returncode != 0 and self.OP_STDIN_UNSUPPORTED_ERROR in errors.result()
+        missing = [key for key in keys if key['id'] not in publicKeys]
+        if missing and (publicKeys or stdinUnsupported):
+            with ThreadPoolExecutor(max_workers=self.FETCH_WORKERS) as executor:
+                futures = [executor.submit(self._getPublicKey, key, (cache or {}).get(key['id'])) for key in missing]
+            for key, future in zip(missing, futures):
+                if not isinstance(future.exception(), subprocess.CalledProcessError):
+                    publicKeys[key['id']] = future.result()
+        return publicKeys
+
+    async def _getPublicKeysWithSdk(self, keys):
+        items = await asyncio.gather(
+            *(self.client.items.get(key['vault']['id'], key['id']) for key in keys), return_exceptions=True
+        )
+        publicKeys = {}
+        for key, item in zip(keys, items):
+            if isinstance(item, Exception):
+                print(f'ERROR: Couldn\'t load {key["title"]!r}: {item}', file=sys.stderr)
+            else:
+                publicKeys[item.id] = self._parseSdkFields(item)
+        return publicKeys
+
+    def _getPublicKey(self, key, cachedFields=None):
+        """Loads URL and public key for a given item id.
+        op rejects a --fields filter if one of the labels is missing, so only the used FIELDS are requested if the cached entry shows that the item has all of them.
+        If the filtered call fails (e.g. because a field was removed since), the whole item is loaded."""
+        # close_fds=False lets subprocess use posix_spawn for the per-item calls. Descriptors opened by Python are non-inheritable,
+        # but inheritable descriptors the script itself was started with are passed on to op.
+        command = [self.OP, 'item', 'get', key['id'], '--format=JSON']
+        if not cachedFields or not all(name in cachedFields for name in self.CACHED_FIELDS):
+            return self._parseFields(json.loads(subprocess.check_output(command, close_fds=False)))
+
+        try:
+            keyData = subprocess.check_output(command + ['--fields', self.FIELDS], stderr=subprocess.DEVNULL, close_fds=False)
+        except subprocess.CalledProcessError:
+            # Real errors (e.g. not being signed in) fail again and show op's error message
+            keyData = subprocess.check_output(command, close_fds=False)
+        return self._parseFields(json.loads(keyData))
+
+    def _parseFields(self, item):
+        # Full items contain their fields, filtered output is a list of fields (or a single field)
+        if isinstance(item, dict):
+            item = item.get('fields', [item])
+        return {entry['label'].lower(): entry.get('value') for entry in item}
+
+    def _parseSdkFields(self, item):
+        fields = {}
+        for field in item.fields:
+            fields[field.title.lower()] = field.value
+            # SSH key fields hold the private key as value and the public key in their details
+            if publicKey := getattr(getattr(field.details, 'content', None), 'public_key', None):
+                fields['public key'] = publicKey
+        return fields
+
+    def _writeInput(self, stream, data):
+        try:
+            stream.write(data)
+            stream.close()
+        except BrokenPipeError:
+            pass
+
+    def _iterJson(self, stream):
+        """Yields the top level JSON objects of a concatenated JSON stream as soon as they are complete"""
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder('utf-8')()
+        data = ''
+        for chunk in iter(lambda: stream.read(65536), b''):
+            data += utf8.decode(chunk)
+            pos = 0
+            while True:
+                while pos < len(data) and data[pos].isspace():
+                    pos += 1
+                try:
+                    obj, pos = decoder.raw_decode(data, pos)
+                except json.JSONDecodeError:
+                    break
+                yield obj
+            data = data[pos:]
+        if data.strip():
+            print(f'WARNING: Ignored {len(data.strip())} characters of unexpected op output: {data.strip()[:80]!r}', file=sys.stderr)
 
     def _getShortTitle(self, key):
-        return re.sub(r'(ssh(\-key)?)|[^a-z0-9]+', '', key['title'].lower())
+        if '_short_title' not in key:
+            key['_short_title'] = self._SHORT_TITLE_RE.sub('', key['title'].lower())
+        return key['_short_title']
 
     def _splitLabels(self, labels):
-        return [label for label in labels.replace(' ', ',').split(',') if label]
+        return [label for label in self._LABEL_SPLIT_RE.split(labels) if label]
 
 
 if __name__ == '__main__':
@@ -162,29 +400,33 @@ if __name__ == '__main__':
         print('    Defines the behaviour if a key has no field labelled "Labels"')
         print('    - use-default: Will use the URL and a short name that is generated from the keys title as default (default)')
         print('    - prompt: Will prompt for labels')
+        print('  --no-cache')
+        print('    Loads all keys from 1Password, even if they didn\'t change since the last run')
         sys.exit(0)
 
-    useraction = 'prompt'
-    urlaction = 'prompt'
-    labelsaction = 'use-default'
+    options = {
+        '--if-user-empty': 'prompt',
+        '--if-url-empty': 'prompt',
+        '--if-labels-empty': 'use-default',
+    }
+    allowedValues = {
+        '--if-url-empty': ('prompt', 'leave-empty'),
+        '--if-labels-empty': ('prompt', 'use-default'),
+    }
+    useCache = True
     for arg in sys.argv[1:]:
-        if arg.startswith('--if-user-empty='):
-            useraction = arg.replace('--if-user-empty=', '')
-        elif arg.startswith('--if-url-empty='):
-            urlaction = arg.replace('--if-url-empty=', '')
-            if urlaction not in (allowed := ('prompt', 'leave-empty')):
-                print('Invalid value for argument "--if-url-empty":', urlaction)
-                print('Allowed values:', ", ".join(allowed))
-                sys.exit(1)
-        elif arg.startswith('--if-labels-empty='):
-            labelsaction = arg.replace('--if-labels-empty=', '')
-            if labelsaction not in (allowed := ('prompt', 'use-default')):
-                print('Invalid value for argument "--if-labels-empty":', labelsaction)
-                print('Allowed values:', ", ".join(allowed))
+        name, hasValue, value = arg.partition('=')
+        if hasValue and name in options:
+            if value not in allowedValues.get(name, (value,)):
+                print(f'Invalid value for argument "{name}":', value)
+                print('Allowed values:', ", ".join(allowedValues[name]))
                 sys.exit(1)
+            options[name] = value
+        elif arg == '--no-cache':
+            useCache = False
         else:
             print(f'Error: Unknown argument: "{arg}"')
             sys.exit(1)
 
-    importer = SSHKeyImporter(useraction, urlaction, labelsaction)
+    importer = SSHKeyImporter(options['--if-user-empty'], options['--if-url-empty'], options['--if-labels-empty'], useCache)
     importer.startImport()